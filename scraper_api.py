@@ -1,10 +1,18 @@
 from fastapi import FastAPI, HTTPException, Query
 import httpx
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 import uvicorn
 import re
 from fastapi.middleware.cors import CORSMiddleware
 import logging
+import asyncio
+import time
+import functools
+import codecs
+import os
+import pathlib
+from cachetools import TTLCache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,98 +32,317 @@ app.add_middleware(
 UAF_LOGIN_URL = "https://lms.uaf.edu.pk/login/index.php"
 UAF_RESULT_URL = "https://lms.uaf.edu.pk/course/uaf_student_result.php"
 
-@app.post("/fetch")
-async def fetch_uaf_results(registration_number: str = Query(..., alias="registration_number")):
+# Compiled once at import instead of on every request
+TOKEN_ANCHOR = b"document.getElementById('token').value='"
+TOKEN_MAX_LEN = 256
+AUTH_DENIED = b"You are not authorize"
+REG_RE = re.compile(r"\d{4}-[a-zA-Z]{2,4}-\d{3,5}")  # e.g. 2020-ag-1234
+MARKERS = {"name": b"Student Full Name", "course": b"Course Code"}
+MARKER_RES = {kind: re.compile(re.escape(marker), re.I) for kind, marker in MARKERS.items()}
+
+STUDENT_INFO_TEMPLATE = {
+    "registration_number": None,
+    "full_name": None,
+    "program": "Inferred Degree",
+    "department": "" # Leave empty to let PHP infer from courses
+}
+
+# Set DEBUG_DUMP_HTML=1 to save the last result page that yielded no courses
+DEBUG_DUMP_HTML = os.environ.get("DEBUG_DUMP_HTML") == "1"
+DEBUG_DUMP_PATH = pathlib.Path(os.environ.get("DEBUG_DUMP_PATH", r"c:\xampp\htdocs\debug_last_fail.html"))
+DEBUG_DUMP_MAX_BYTES = 1024 * 1024
+
+# XPath 1.0 has no lower-case(), so translate() is used for case-insensitive matching
+_LOWER = "translate(., 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')"
+# Anchored on the text node so the nearest row wins over outer layout rows (like find_parent('tr'))
+NAME_XPATH = etree.XPath(f"//text()[contains({_LOWER}, 'student full name')]/ancestor::tr[1]/td[2]")
+TAG_RES = {tag: re.compile(rb"<(/?)" + tag + rb"\b[^>]*>", re.I) for tag in (b"tr", b"table")}
+PARSE_CHUNK_SIZE = 16384
+ROWS_XPATH = etree.XPath(".//tr")
+CELLS_XPATH = etree.XPath("./td")
+
+def extract_token(body, start=0):
     """
-    Fetches student results from the UAF portal.
+    Looks for the token assigned in the login page script, searching body from `start`.
+    Returns (token or None, offset to resume from once more bytes have been appended).
+    """
+    while True:
+        anchor = body.find(TOKEN_ANCHOR, start)
+        if anchor == -1:
+            # Keep enough of the tail to catch an anchor split across chunks
+            return None, max(start, len(body) - len(TOKEN_ANCHOR) + 1)
+        value_start = anchor + len(TOKEN_ANCHOR)
+        end = body.find(b"'", value_start, value_start + TOKEN_MAX_LEN + 1)
+        if end != -1:
+            return bytes(body[value_start:end]).decode(), end
+        if len(body) - value_start <= TOKEN_MAX_LEN:
+            # Closing quote may still be on its way
+            return None, anchor
+        # No closing quote where one should be; look for a later anchor
+        start = anchor + 1
+
+@functools.lru_cache(maxsize=32)
+def lxml_encoding(encoding):
     """
+    Maps a Python codec name (as validated by httpx) to one libxml2 accepts, else UTF-8.
+    """
+    name = codecs.lookup(encoding).name
     try:
-        async with httpx.AsyncClient(timeout=30.0, verify=False, follow_redirects=True) as client:
-            # 1. Fetch login page to get session cookies and token
-            response = await client.get(UAF_LOGIN_URL)
+        lxml.html.HTMLParser(encoding=name)
+    except LookupError:
+        return "utf-8"
+    return name
+
+@functools.lru_cache(maxsize=32)
+def html_parser(encoding):
+    """
+    Returns a shared lxml HTML parser that decodes raw bytes with the given encoding.
+    """
+    return lxml.html.HTMLParser(encoding=encoding)
+
+def find_markers(html):
+    """
+    Returns the (start, end) span of the first occurrence of each marker found in html.
+    """
+    spans = {}
+    for kind, marker in MARKERS.items():
+        # Plain bytes.find first; the case-insensitive regex is much slower and only a fallback
+        start = html.find(marker)
+        if start != -1:
+            spans[kind] = (start, start + len(marker))
+            continue
+        match = MARKER_RES[kind].search(html)
+        if match:
+            spans[kind] = match.span()
+    return spans
+
+def enclosing_element(html, span, tag, encoding, innermost=False):
+    """
+    Parses the <tag> element around span, or returns None. By default this is the outermost
+    one (the first match in document order, as a full-document search would pick); with
+    innermost=True it is the nearest enclosing one, like BeautifulSoup's find_parent().
+    """
+    if span is None:
+        return None
+    # Balance open/close tags so nested elements neither cut the slice short nor get picked
+    # by accident; `opened` holds the start offsets of the currently open elements
+    opened = []
+    for match in TAG_RES[tag].finditer(html):
+        if not match.group(1):
+            if not opened and match.start() > span[0]:
+                return None
+            opened.append(match.start())
+            continue
+        if not opened:
+            continue
+        start = opened.pop()
+        if match.start() < span[1] or start > span[0]:
+            continue
+        if innermost or not opened:
+            try:
+                return lxml.html.fragment_fromstring(html[start:match.end()], parser=html_parser(encoding))
+            except etree.ParserError:
+                return None
+    return None
+
+def find_course_table(html, encoding):
+    """
+    Stream-parses html until the first table containing "Course Code".
+    Returns (table or None, number of tables seen).
+    """
+    parser = etree.HTMLPullParser(events=("end",), tag="table", encoding=encoding)
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+
+    def table_events():
+        for i in range(0, len(html), PARSE_CHUNK_SIZE):
+            parser.feed(html[i:i + PARSE_CHUNK_SIZE])
+            yield from parser.read_events()
+        # Tables left unclosed at the end of the page only get their end event on close()
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            # Empty or tag-less page: nothing left to report
+            return
+        yield from parser.read_events()
+
+    seen = 0
+    for _, table in table_events():
+        seen += 1
+        # Nested tables end before their parents; only top-level tables are judged so the
+        # outermost match wins, like the full-document search
+        if next(table.iterancestors("table"), None) is not None:
+            continue
+        if "course code" in table.text_content().lower():
+            return table, seen
+        table.clear()
+    return None, seen
+
+def parse_courses(table):
+    """
+    Extracts course rows from the results table.
+    """
+    rows = [CELLS_XPATH(row) for row in ROWS_XPATH(table)]
+    return [
+        {
+            "Semester": cols[1].text_content().strip(),
+            "Course Code": cols[3].text_content().strip(),
+            "Course Title": cols[4].text_content().strip(),
+            "Credit Hours": cols[5].text_content().strip(),
+            "Total": cols[10].text_content().strip(),
+            "Grade": cols[11].text_content().strip()
+        }
+        for cols in rows
+        # We need at least 14 columns based on the screenshot/logic
+        if len(cols) >= 12
+    ]
+
+# Shared across requests so keep-alive connections to the UAF server are reused
+CLIENT = None
+
+@app.on_event("startup")
+async def startup():
+    global CLIENT
+    CLIENT = httpx.AsyncClient(
+        timeout=30.0,
+        verify=False,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        http2=True,
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    await CLIENT.aclose()
+
+# The login-page token stays valid for the session held in CLIENT's cookie jar
+TOKEN_TTL = 600
+_TOKEN_CACHE = {"token": None, "fetched_at": 0.0}
+_TOKEN_LOCK = asyncio.Lock()
+
+async def get_token(stale=None):
+    """
+    Returns the UAF security token, fetching the login page only when the cached one is missing,
+    expired, or equal to `stale` (a token the server just rejected).
+    """
+    async with _TOKEN_LOCK:
+        if _TOKEN_CACHE["token"] not in (None, stale) and time.monotonic() - _TOKEN_CACHE["fetched_at"] < TOKEN_TTL:
+            return _TOKEN_CACHE["token"]
+
+        # Fetch login page to get session cookies and token, stopping as soon as the token shows up
+        # Leaving the stream early closes it; on HTTP/1.1 that costs the pooled connection
+        token = None
+        body = bytearray()
+        resume = 0
+        async with CLIENT.stream("GET", UAF_LOGIN_URL) as response:
             response.raise_for_status()
-            
-            # Extract token using regex
-            token_match = re.search(r"document\.getElementById\('token'\)\.value='(.*?)'", response.text)
-            if not token_match:
-                raise HTTPException(status_code=500, detail="Could not find security token on UAF page.")
-            
-            token = token_match.group(1)
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                token, resume = extract_token(body, resume)
+                if token is not None:
+                    break
 
-            # 2. POST to result page with cookies and token
-            payload = {
-                "token": token,
-                "Register": registration_number
-            }
-            
-            res_response = await client.post(UAF_RESULT_URL, data=payload)
+        if token is None:
+            raise HTTPException(status_code=500, detail="Could not find security token on UAF page.")
+
+        _TOKEN_CACHE["token"] = token
+        _TOKEN_CACHE["fetched_at"] = time.monotonic()
+        return _TOKEN_CACHE["token"]
+
+# Recent results per registration number, plus scrapes currently in progress
+_RESULT_CACHE = TTLCache(maxsize=1024, ttl=300)
+_IN_FLIGHT = {}
+
+def finish_scrape(registration_number, task):
+    """
+    Done-callback for a shared scrape task: forgets it and marks any exception as retrieved,
+    so a failure nobody is still waiting on doesn't log "Task exception was never retrieved".
+    """
+    _IN_FLIGHT.pop(registration_number, None)
+    if not task.cancelled():
+        task.exception()
+
+async def scrape_uaf_results(registration_number):
+    """
+    Fetches student results from the UAF portal.
+    """
+    try:
+        # 1. Get a security token (cached between requests)
+        token = await get_token()
+
+        # 2. POST to result page with cookies and token
+        payload = {
+            "token": token,
+            "Register": registration_number
+        }
+        
+        res_response = await CLIENT.post(UAF_RESULT_URL, data=payload)
+        res_response.raise_for_status()
+        
+        if AUTH_DENIED in res_response.content:
+            # Cached token may have gone stale; retry once with a fresh one
+            payload["token"] = await get_token(stale=token)
+            res_response = await CLIENT.post(UAF_RESULT_URL, data=payload)
             res_response.raise_for_status()
-            
-            if "You are not authorize" in res_response.text:
+
+            if AUTH_DENIED in res_response.content:
+                _TOKEN_CACHE["token"] = None
                 raise HTTPException(status_code=403, detail="UAF Server denied authorization (Session expired or blocked).")
 
-            # 3. Parse HTML
-            soup = BeautifulSoup(res_response.text, 'html.parser')
+        # 3. Parse HTML
+        # Fast path: parse only the elements around the markers instead of the whole page
+        # Work on the raw bytes with the declared charset rather than decoding to str first;
+        # .encoding falls back to UTF-8 for unknown charsets, same as .text would
+        html = res_response.content
+        encoding = lxml_encoding(res_response.encoding)
+        markers = find_markers(html)
+
+        # Extract Student Name
+        name_row = enclosing_element(html, markers.get("name"), b"tr", encoding, innermost=True)
+        name_cells = name_row.xpath("./td[2]") if name_row is not None else []
+        # Only worth a full parse if the marker is there at all; an empty page can't be parsed
+        if not name_cells and "name" in markers:
+            try:
+                name_cells = NAME_XPATH(lxml.html.fromstring(html, parser=html_parser(encoding)))
+            except etree.ParserError:
+                name_cells = []
+        student_name = "Unknown Student"
+        if name_cells:
+            student_name = name_cells[0].text_content().strip()
+
+        # Extract Course Table
+        target_table = enclosing_element(html, markers.get("course"), b"table", encoding)
+        courses = parse_courses(target_table) if target_table is not None else []
+
+        if not courses:
+            # Fall back to stream-parsing the document up to the first matching table
+            target_table, tables = find_course_table(html, encoding)
+            if target_table is not None:
+                courses = parse_courses(target_table)
+
+        if not courses:
+            debug_info = f"Found {tables} tables. Target table found: {target_table is not None}. "
+            if target_table is not None:
+               debug_info += f"Rows: {len(target_table.xpath('.//tr'))}. "
             
-            # Extract Student Name
-            # Use regex for flexibility (case/whitespace)
-            name_cell = soup.find(string=re.compile("Student Full Name", re.I))
-            student_name = "Unknown Student"
-            if name_cell:
-                name_row = name_cell.find_parent('tr')
-                if name_row:
-                    cells = name_row.find_all('td')
-                    if len(cells) > 1:
-                        student_name = cells[1].text.strip()
-
-            # Extract Course Table
-            courses = []
-            # Find the specific table containing "Course Code"
-            tables = soup.find_all('table')
-            target_table = None
-            for t in tables:
-                if t.find(string=re.compile("Course Code", re.I)):
-                    target_table = t
-                    break
+            if DEBUG_DUMP_HTML:
+                # Save HTML for debugging, off the event loop
+                await asyncio.to_thread(DEBUG_DUMP_PATH.write_bytes, html[:DEBUG_DUMP_MAX_BYTES])
+                logger.warning(f"No courses found for {registration_number}. HTML saved to {DEBUG_DUMP_PATH}")
+            else:
+                logger.warning(f"No courses found for {registration_number}.")
             
-            if target_table:
-                rows = target_table.find_all('tr')
-                # Skip header row(s). Usually the first row is header.
-                for row in rows:
-                    cols = row.find_all('td')
-                    # We need at least 14 columns based on the screenshot/logic
-                    if len(cols) >= 12: 
-                        courses.append({
-                            "Semester": cols[1].text.strip(),
-                            "Course Code": cols[3].text.strip(),
-                            "Course Title": cols[4].text.strip(),
-                            "Credit Hours": cols[5].text.strip(),
-                            "Total": cols[10].text.strip(),
-                            "Grade": cols[11].text.strip()
-                        })
-
-            if not courses:
-                debug_info = f"Found {len(tables)} tables. Target table found: {target_table is not None}. "
-                if target_table:
-                   debug_info += f"Rows: {len(target_table.find_all('tr'))}. "
-                
-                # Save HTML for debugging
-                with open(r"c:\xampp\htdocs\debug_last_fail.html", "w", encoding="utf-8") as f:
-                    f.write(res_response.text)
-                logger.warning(f"No courses found for {registration_number}. HTML saved to debug_last_fail.html")
-                
-                raise HTTPException(status_code=404, detail=f"No course results found. Debug: {debug_info}")
-
-            return {
-                "success": True,
-                "student_info": {
-                    "registration_number": registration_number,
-                    "full_name": student_name,
-                    "program": "Inferred Degree", 
-                    "department": "" # Leave empty to let PHP infer from courses
-                },
-                "courses": courses
-            }
+            raise HTTPException(status_code=404, detail=f"No course results found. Debug: {debug_info}")
+
+        result = {
+            "success": True,
+            "student_info": STUDENT_INFO_TEMPLATE | {
+                "registration_number": registration_number,
+                "full_name": student_name,
+            },
+            "courses": courses
+        }
+        _RESULT_CACHE[registration_number] = result
+        return result
 
     except HTTPException as e:
         logger.error(f"HTTPException: {e.detail}")
@@ -124,13 +351,37 @@ async def fetch_uaf_results(registration_number: str = Query(..., alias="registr
         logger.error(f"HTTPX Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch from UAF: {str(e)}")
     except Exception as e:
-        import traceback
-        error_msg = f"Scraping error: {str(e)}\n{traceback.format_exc()}"
-        logger.error(error_msg)
+        logger.exception("Scraping error for %s", registration_number)
         raise HTTPException(status_code=500, detail=f"Scraping error: {str(e)}")
 
+@app.post("/fetch")
+async def fetch_uaf_results(registration_number: str = Query(..., alias="registration_number")) -> dict:
+    """
+    Serves results from the cache when possible; concurrent lookups for the
+    same registration number share a single upstream scrape.
+    """
+    # Reject malformed numbers before they cost any upstream requests
+    if not REG_RE.fullmatch(registration_number):
+        raise HTTPException(status_code=422, detail="Invalid registration number format")
+
+    # Single lookup: the entry could expire between a membership test and a read
+    cached = _RESULT_CACHE.get(registration_number)
+    if cached is not None:
+        return {**cached, "cached": True}
+
+    task = _IN_FLIGHT.get(registration_number)
+    if task is None:
+        task = asyncio.ensure_future(scrape_uaf_results(registration_number))
+        _IN_FLIGHT[registration_number] = task
+        task.add_done_callback(lambda t: finish_scrape(registration_number, t))
+
+    # shield() so a client disconnecting doesn't cancel the scrape other callers are waiting on
+    result = await asyncio.shield(task)
+    return {**result, "cached": False}
+
 if __name__ == "__main__":
-    import os
     port = int(os.environ.get("PORT", 8081))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # "auto" picks uvloop/httptools when installed (uvloop isn't available on Windows)
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 2))
+    uvicorn.run("scraper_api:app", host="0.0.0.0", port=port, loop="auto", http="auto", workers=workers)
 